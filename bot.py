@@ -1,10 +1,17 @@
-import os, json, time, sqlite3, threading, urllib.parse
+import os, json, time, random, hashlib, base64, secrets, sqlite3, threading, queue, asyncio, urllib.parse, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
 from pathlib import Path
-from typing import Optional
+from typing import Optional, BinaryIO
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 import uvicorn
 
 from telegram import Update, Chat, InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,6 +21,11 @@ from io import BytesIO
 from PIL import Image, ImageOps
 import pillow_heif  # registers HEIF/HEIC/AVIF with Pillow
 pillow_heif.register_heif_opener()
+try:
+    import orjson  # faster Telegram response parsing, if installed
+    json_loads, json_dumps = orjson.loads, lambda o: orjson.dumps(o).decode()
+except ImportError:
+    json_loads, json_dumps = json.loads, json.dumps
 
 # Load .env in current folder (adjust if your .env is elsewhere)
 load_dotenv()
@@ -26,88 +38,166 @@ CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 PUBLIC_BASE = os.getenv("PUBLIC_BASE_URL", "")
 REDIRECT_PATH = os.getenv("REDIRECT_PATH", "/oauth/callback")
 REDIRECT_URI = f"{PUBLIC_BASE}{REDIRECT_PATH}"
+TG_WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/tg")
+# Telegram echoes this back on every webhook call; random per run unless pinned in .env
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 DB_PATH = "bot.db"
 PHOTO_MAX = 10 * 1024 * 1024     # 10MB photo limit
 FILE_MAX  = 2 * 1024**3          # 2GB bot API limit
+TG_MAX_PER_SEC = 30              # Telegram bulk-send cap
+TG_CHAT_PER_MIN = 20             # Telegram per-group/channel cap
+TG_RETRIES = 5                   # attempts per call when Telegram answers 429
+UPLOAD_WORKERS = 1               # one in-order uploader per chat; the per-chat cap is the bottleneck anyway
+ALBUM_MAX = 10                   # sendMediaGroup item limit
+POLL_MAX  = 60.0                 # Picker polling backoff ceiling (seconds)
+CPU_WORKERS = 2                  # Pillow re-encode processes (one conversion in flight per picker job)
+SHRINK_SIDE = 4096               # longest side when re-encoding >10MB images as photos
+SHRINK_BIG_PHOTOS = os.getenv("SHRINK_BIG_PHOTOS", "") == "1"  # else they go as documents
 
 PHOTOS_PICKER_BASE = "https://photospicker.googleapis.com/v1"
 SCOPE = "https://www.googleapis.com/auth/photospicker.mediaitems.readonly openid email"
 AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth"
 TOKEN_URL = "https://oauth2.googleapis.com/token"
 
+# Shared keep-alive session for all Google / Telegram HTTPS calls
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 # --- DB helpers ---
+# Server-tuned defaults; applied once per physical connection
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=30000;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA foreign_keys=ON;
+"""
+
 def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.executescript(DB_PRAGMAS)
     return conn
 
+class Pool:
+    """One shared writer (serialized by a lock) + one reader per thread (WAL allows concurrent reads)."""
+    def __init__(self):
+        self.writer = db()
+        self.writer_lock = threading.Lock()
+        self._tls = threading.local()
+
+    def reader(self):
+        conn = getattr(self._tls, "conn", None)
+        if conn is None:
+            conn = self._tls.conn = db()
+        return conn
+
+    @contextmanager
+    def write(self):
+        """Locked writer inside one BEGIN IMMEDIATE transaction; commits on exit, rolls back on error."""
+        with self.writer_lock, self.writer:
+            self.writer.execute("BEGIN IMMEDIATE")
+            yield self.writer
+
+    def close(self):
+        # let SQLite refresh planner stats for what this process queried
+        with self.writer_lock:
+            self.writer.execute("PRAGMA optimize;")
+            self.writer.close()
+
+pool: Optional[Pool] = None
+
+SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS users(
+    tg_id INTEGER PRIMARY KEY,
+    email TEXT,
+    access_token TEXT,
+    refresh_token TEXT,
+    token_type TEXT,
+    expiry INTEGER
+);
+CREATE TABLE IF NOT EXISTS channels(
+    tg_id INTEGER,
+    chat_id TEXT,
+    title TEXT,
+    PRIMARY KEY (tg_id)
+);
+CREATE TABLE IF NOT EXISTS link_codes(
+    code TEXT PRIMARY KEY,
+    tg_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS uploaded(
+    sha256 TEXT PRIMARY KEY,
+    kind TEXT,
+    file_id TEXT,
+    mime TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_channels_chatid ON channels(chat_id);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email) WHERE email IS NOT NULL;
+COMMIT;
+PRAGMA optimize;
+"""
+
 def init_db():
-    conn = db()
-    conn.execute("""CREATE TABLE IF NOT EXISTS users(
-        tg_id INTEGER PRIMARY KEY,
-        email TEXT,
-        access_token TEXT,
-        refresh_token TEXT,
-        token_type TEXT,
-        expiry INTEGER
-    )""")
-    conn.execute("""CREATE TABLE IF NOT EXISTS channels(
-        tg_id INTEGER,
-        chat_id TEXT,
-        title TEXT,
-        PRIMARY KEY (tg_id)
-    )""")
-    conn.execute("""CREATE TABLE IF NOT EXISTS link_codes(
-        code TEXT PRIMARY KEY,
-        tg_id INTEGER
-    )""")
-    conn.commit()
-    conn.close()
+    global pool
+    pool = Pool()
+    with pool.writer_lock:
+        pool.writer.executescript(SCHEMA)
 
 def save_tokens(tg_id:int, token:dict, email:str|None=None):
-    conn = db()
     expiry = int(time.time()) + int(token.get("expires_in", 3600)) - 60
-    conn.execute("INSERT OR REPLACE INTO users(tg_id,email,access_token,refresh_token,token_type,expiry) VALUES(?,?,?,?,?,?)",
-                 (tg_id, email, token.get("access_token"), token.get("refresh_token"),
-                  token.get("token_type"), expiry))
-    conn.commit(); conn.close()
+    with pool.write() as conn:
+        conn.execute("INSERT INTO users(tg_id,email,access_token,refresh_token,token_type,expiry) VALUES(?,?,?,?,?,?) "
+                     "ON CONFLICT(tg_id) DO UPDATE SET email=excluded.email, access_token=excluded.access_token, "
+                     "refresh_token=excluded.refresh_token, token_type=excluded.token_type, expiry=excluded.expiry",
+                     (tg_id, email, token.get("access_token"), token.get("refresh_token"),
+                      token.get("token_type"), expiry))
+    if token.get("access_token"):
+        _token_cache[tg_id] = (token["access_token"], expiry)
 
 def get_user(tg_id:int)->Optional[dict]:
-    conn = db()
-    cur = conn.execute("SELECT tg_id,email,access_token,refresh_token,token_type,expiry FROM users WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone(); conn.close()
+    cur = pool.reader().execute("SELECT tg_id,email,access_token,refresh_token,token_type,expiry FROM users WHERE tg_id=?", (tg_id,))
+    row = cur.fetchone()
     if not row: return None
     keys = ["tg_id","email","access_token","refresh_token","token_type","expiry"]
     return dict(zip(keys, row))
 
 def save_channel(tg_id:int, chat_id:str, title:str|None):
-    conn = db()
-    conn.execute("INSERT OR REPLACE INTO channels(tg_id,chat_id,title) VALUES(?,?,?)", (tg_id, chat_id, title))
-    conn.commit(); conn.close()
+    with pool.write() as conn:
+        conn.execute("INSERT INTO channels(tg_id,chat_id,title) VALUES(?,?,?) "
+                     "ON CONFLICT(tg_id) DO UPDATE SET chat_id=excluded.chat_id, title=excluded.title",
+                     (tg_id, chat_id, title))
 
 def get_channel(tg_id:int)->Optional[dict]:
-    conn = db()
-    cur = conn.execute("SELECT tg_id,chat_id,title FROM channels WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone(); conn.close()
+    cur = pool.reader().execute("SELECT tg_id,chat_id,title FROM channels WHERE tg_id=?", (tg_id,))
+    row = cur.fetchone()
     if not row: return None
     return {"tg_id":row[0], "chat_id":row[1], "title":row[2]}
 
 def put_link_code(code:str, tg_id:int):
-    conn = db()
-    conn.execute("INSERT OR REPLACE INTO link_codes(code,tg_id) VALUES(?,?)", (code, tg_id))
-    conn.commit(); conn.close()
+    with pool.write() as conn:
+        conn.execute("INSERT INTO link_codes(code,tg_id) VALUES(?,?) "
+                     "ON CONFLICT(code) DO UPDATE SET tg_id=excluded.tg_id", (code, tg_id))
 
 def pop_link_code(code:str)->Optional[int]:
-    conn = db()
-    cur = conn.execute("SELECT tg_id FROM link_codes WHERE code=?", (code,))
-    row = cur.fetchone()
-    if row:
-        conn.execute("DELETE FROM link_codes WHERE code=?", (code,))
-        conn.commit()
-    conn.close()
+    with pool.write() as conn:
+        row = conn.execute("DELETE FROM link_codes WHERE code=? RETURNING tg_id", (code,)).fetchone()
     return row[0] if row else None
 
+def get_upload(sha256:str)->Optional[tuple[str,str]]:
+    """(kind, file_id) of content Telegram already has, by content hash."""
+    return pool.reader().execute("SELECT kind,file_id FROM uploaded WHERE sha256=?", (sha256,)).fetchone()
+
+def save_upload(sha256:str, kind:str, file_id:str, mime:str|None):
+    with pool.write() as conn:
+        conn.execute("INSERT INTO uploaded(sha256,kind,file_id,mime) VALUES(?,?,?,?) "
+                     "ON CONFLICT(sha256) DO UPDATE SET kind=excluded.kind, file_id=excluded.file_id, mime=excluded.mime",
+                     (sha256, kind, file_id, mime))
 
 # -conversion helpers-
 def _to_rgb_no_alpha(img: Image.Image) -> Image.Image:
@@ -120,11 +210,11 @@ def _to_rgb_no_alpha(img: Image.Image) -> Image.Image:
         return img.convert("RGB")
     return img
 
-def heic_to_jpeg_bytes(content: bytes, filename: str) -> tuple[bytes, str, str]:
+def heic_to_jpeg_bytes(content: bytes, filename: str, max_side: int = MAX_SIDE) -> tuple[bytes, str, str]:
     """
-    Decode HEIC/HEIF/AVIF -> JPEG bytes that are Telegram-friendly.
+    Decode HEIC/HEIF/AVIF (or any Pillow-readable image) -> JPEG bytes that are Telegram-friendly.
     - auto-orients via EXIF
-    - clamps longest side to 10,000 px
+    - clamps longest side to max_side (default 10,000 px)
     - compresses to <= 10 MB if possible
     Returns: (jpeg_bytes, new_filename, "image/jpeg")
     """
@@ -134,8 +224,8 @@ def heic_to_jpeg_bytes(content: bytes, filename: str) -> tuple[bytes, str, str]:
 
     # Clamp size to avoid PHOTO_INVALID_DIMENSIONS
     w, h = img.size
-    if max(w, h) > MAX_SIDE:
-        scale = MAX_SIDE / float(max(w, h))
+    if max(w, h) > max_side:
+        scale = max_side / float(max(w, h))
         img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
 
     exif = img.info.get("exif")
@@ -155,31 +245,57 @@ def heic_to_jpeg_bytes(content: bytes, filename: str) -> tuple[bytes, str, str]:
                  exif=exif if exif else None, icc_profile=icc if icc else None)
         data = out.getvalue()
 
-    new_name = re.sub(r"\.(heic|heif|avif)$", ".jpg", filename, flags=re.I)
-    if new_name == filename:
-        new_name = filename + ".jpg"
+    new_name = os.path.splitext(filename)[0] + ".jpg"
     return data, new_name, "image/jpeg"
 
+# CPU-bound Pillow work runs in worker processes so it doesn't hold the GIL
+# against the download/upload threads
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
+
+def _get_cpu_pool() -> ProcessPoolExecutor:
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            # never fork(): this process has live threads, the event loop and DB handles by now
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _cpu_pool = ProcessPoolExecutor(max_workers=min(CPU_WORKERS, os.cpu_count() or 1),
+                                            mp_context=multiprocessing.get_context(method))
+        return _cpu_pool
+
+def to_jpeg_off_thread(content: bytes, filename: str, max_side: int = MAX_SIDE) -> tuple[bytes, str, str]:
+    global _cpu_pool
+    pool = _get_cpu_pool()
+    try:
+        return pool.submit(heic_to_jpeg_bytes, content, filename, max_side).result()
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM-killed on a huge image); start a fresh pool and retry once
+        with _cpu_pool_lock:
+            if _cpu_pool is pool:
+                _cpu_pool = None
+        return _get_cpu_pool().submit(heic_to_jpeg_bytes, content, filename, max_side).result()
+
 def is_heic_like(name: str, mime: str | None) -> bool:
     m = (mime or "").lower()
     if m in ("image/heic", "image/heif", "image/heif-sequence", "image/avif"):
         return True
     return bool(re.search(r"\.(heic|heif|avif)$", name, flags=re.I))
 # --- Google OAuth helpers ---
+# everything except state is fixed, so encode it once
+_OAUTH_URL_PREFIX = AUTH_URL + "?" + urllib.parse.urlencode({
+    "client_id": CLIENT_ID,
+    "redirect_uri": REDIRECT_URI,
+    "response_type": "code",
+    "scope": SCOPE,
+    "access_type": "offline",
+    "prompt": "consent",
+}) + "&state="
+
 def oauth_url(state:str):
-    params = {
-        "client_id": CLIENT_ID,
-        "redirect_uri": REDIRECT_URI,
-        "response_type": "code",
-        "scope": SCOPE,
-        "access_type": "offline",
-        "prompt": "consent",
-        "state": state,
-    }
-    return f"{AUTH_URL}?{urllib.parse.urlencode(params)}"
+    return _OAUTH_URL_PREFIX + urllib.parse.quote_plus(state, safe="")
 
 def exchange_code(code:str)->dict:
-    r = requests.post(TOKEN_URL, data={
+    r = SESSION.post(TOKEN_URL, data={
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
         "code": code,
@@ -189,8 +305,21 @@ def exchange_code(code:str)->dict:
     r.raise_for_status()
     return r.json()
 
+def id_token_email(token:dict)->Optional[str]:
+    """
+    Email from the token response's id_token (scope includes 'openid email'),
+    saving a userinfo round trip. The JWT came straight from Google's token
+    endpoint over TLS, so its signature isn't re-checked here.
+    """
+    try:
+        payload = token["id_token"].split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("email")
+    except Exception:
+        return None
+
 def refresh_token(refresh_token:str)->dict:
-    r = requests.post(TOKEN_URL, data={
+    r = SESSION.post(TOKEN_URL, data={
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
         "grant_type": "refresh_token",
@@ -199,18 +328,67 @@ def refresh_token(refresh_token:str)->dict:
     r.raise_for_status()
     return r.json()
 
-def get_access_token(u:dict)->str:
-    if int(time.time()) < (u.get("expiry") or 0) and u.get("access_token"):
-        return u["access_token"]
-    if u.get("refresh_token"):
-        t = refresh_token(u["refresh_token"])
-        # sometimes refresh response omits refresh_token; keep old one
-        t.setdefault("refresh_token", u["refresh_token"])
-        save_tokens(u["tg_id"], t, u.get("email"))
-        return t["access_token"]
+# tg_id -> (access_token, expiry); refreshes are serialized per user
+_token_cache: dict[int, tuple[str, int]] = {}
+_refresh_locks: dict[int, threading.Lock] = {}
+
+def _cached_token(tg_id:int)->Optional[str]:
+    hit = _token_cache.get(tg_id)
+    if hit and int(time.time()) < hit[1]:
+        return hit[0]
+    return None
+
+def get_access_token(tg_id:int)->str:
+    token = _cached_token(tg_id)
+    if token:
+        return token
+    with _refresh_locks.setdefault(tg_id, threading.Lock()):
+        # another thread may have refreshed while we waited for the lock
+        token = _cached_token(tg_id)
+        if token:
+            return token
+        u = get_user(tg_id) or {}
+        if int(time.time()) < (u.get("expiry") or 0) and u.get("access_token"):
+            _token_cache[tg_id] = (u["access_token"], u["expiry"])
+            return u["access_token"]
+        if u.get("refresh_token"):
+            t = refresh_token(u["refresh_token"])
+            # sometimes refresh response omits refresh_token; keep old one
+            t.setdefault("refresh_token", u["refresh_token"])
+            save_tokens(tg_id, t, u.get("email"))
+            return t["access_token"]
     raise RuntimeError("No valid Google token; use /connect")
 
 # --- Telegram send helpers (FIXED API) ---
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across all threads."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self, n: int = 1):
+        # a call worth n messages (an album) pushes the next one n intervals out
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval * n
+        if at > now:
+            time.sleep(at - now)
+
+tg_rate = RateLimiter(TG_MAX_PER_SEC)
+_chat_rates: dict[str, RateLimiter] = {}
+_chat_rates_lock = threading.Lock()
+
+def chat_rate(chat_id: int | str) -> RateLimiter:
+    """Per-chat limiter: 1 msg/s in private chats, TG_CHAT_PER_MIN in groups and channels."""
+    key = str(chat_id)
+    with _chat_rates_lock:
+        if key not in _chat_rates:
+            # user ids are positive; group/channel ids are negative or @names
+            _chat_rates[key] = RateLimiter(1.0 if key.isdigit() else TG_CHAT_PER_MIN / 60)
+        return _chat_rates[key]
+
 def tg_send(method: str, *, chat_id: int | str, files=None, **data):
     """
     Send a Telegram API call.
@@ -219,74 +397,230 @@ def tg_send(method: str, *, chat_id: int | str, files=None, **data):
     """
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
     payload = {"chat_id": chat_id, **data}
-    r = requests.post(url, data=payload, files=files, timeout=300)
-    j = r.json() if r.headers.get("content-type","").startswith("application/json") else {}
+    weight = len(json_loads(data["media"])) if method == "sendMediaGroup" else 1
+    for attempt in range(TG_RETRIES):
+        chat_rate(chat_id).wait(weight)
+        tg_rate.wait()
+        if files:
+            for _, content, _ in files.values():
+                if hasattr(content, "seek"):
+                    content.seek(0)  # a retry re-sends the spooled body from the start
+            # stream the multipart body; requests' own encoder would read() every file into memory
+            body = MultipartEncoder({**{k: str(v) for k, v in payload.items()}, **files})
+            r = SESSION.post(url, data=body, headers={"Content-Type": body.content_type}, timeout=300)
+        else:
+            r = SESSION.post(url, data=payload, timeout=300)
+        try:
+            j = json_loads(r.content)  # Telegram always answers JSON, except on proxy/gateway errors
+        except ValueError:
+            j = {"ok": False, "description": r.text}
+        if r.status_code != 429 or attempt == TG_RETRIES - 1:
+            break
+        # flood control: Telegram says how long to back off
+        time.sleep((j.get("parameters") or {}).get("retry_after", 1))
     if r.status_code != 200 or not j.get("ok", False):
         raise RuntimeError(f"Telegram error {r.status_code}: {j}")
     return j
 
-def send_media_auto(dest_chat_id: str, name: str, content: bytes, mime: str | None):
+def _read_all(content: bytes | BinaryIO) -> bytes:
+    return content if isinstance(content, (bytes, bytearray)) else content.read()
+
+def _spool(content: BinaryIO) -> tuple[bytes | BinaryIO, int]:
+    """
+    Copy a stream in 1 MiB chunks, giving up past FILE_MAX.
+    Bodies up to PHOTO_MAX come back as bytes; bigger ones as a temp file on disk,
+    which tg_send streams from, so no upload holds a large file in memory.
+    """
+    buf, size = SpooledTemporaryFile(max_size=PHOTO_MAX), 0
+    while chunk := content.read(1 << 20):
+        size += len(chunk)
+        if size > FILE_MAX:
+            buf.close()
+            raise RuntimeError("File exceeds 2GB")
+        buf.write(chunk)
+    buf.seek(0)
+    if size <= PHOTO_MAX:
+        with buf:
+            return buf.read(), size
+    return buf, size
+
+def _is_photo_error(e: Exception) -> bool:
+    # dimension/processing issues -> retry as document
+    return any(x in str(e) for x in (
+        "PHOTO_INVALID_DIMENSIONS",
+        "IMAGE_PROCESS_FAILED",
+        "PHOTO_EXT_INVALID",
+    ))
+
+def _is_file_id_error(e: Exception) -> bool:
+    # a cached file_id Telegram no longer accepts -> upload the bytes again
+    return "file identifier" in str(e)
+
+def prepare_media(name: str, content: bytes | BinaryIO, mime: str | None, size: int | None = None):
+    """
+    Decide how an item goes to Telegram. Returns (kind, name, content, mime), kind "photo" or "document".
+    content is bytes or a spooled temp file as returned by download_item; size is its length in bytes.
+    """
+    if size is None:
+        size = len(content)
     # 2 GB hard limit
-    if len(content) > FILE_MAX:
+    if size > FILE_MAX:
         raise RuntimeError("File exceeds 2GB")
 
     m = (mime or "").lower()
     # Convert HEIC/HEIF/AVIF -> JPEG for inline album-friendly photos
     if is_heic_like(name, m):
+        content = _read_all(content)
         try:
-            content, name, m = heic_to_jpeg_bytes(content, name)
+            content, name, m = to_jpeg_off_thread(content, name)
+            size = len(content)
         except Exception as e:
             # If conversion fails, send original as document
-            files = {"document": (name, content, mime or "application/octet-stream")}
-            return tg_send("sendDocument", chat_id=dest_chat_id, files=files)
+            return "document", name, content, mime or "application/octet-stream"
 
     # Identify images after conversion
     is_image = (m or "").startswith("image/")
 
-    # Try photo path (Telegram will inline + allow albums); obey 10 MB
-    if is_image and len(content) <= PHOTO_MAX:
-        files = {"photo": (name, content, m or "image/jpeg")}
+    # Photo path (Telegram will inline + allow albums); obey 10 MB.
+    # Bodies this small are already bytes, which keeps the document fallback possible.
+    if is_image and size <= PHOTO_MAX:
+        return "photo", name, content, m or "image/jpeg"
+
+    # Optionally keep big images inline: downscale + re-encode instead of sending a document
+    if is_image and SHRINK_BIG_PHOTOS:
+        content = _read_all(content)
         try:
-            return tg_send("sendPhoto", chat_id=dest_chat_id, files=files)
+            small, small_name, small_m = to_jpeg_off_thread(content, name, SHRINK_SIDE)
+            if len(small) <= PHOTO_MAX:
+                return "photo", small_name, small, small_m
+        except Exception:
+            pass  # not decodable by Pillow; send the original as a document
+
+    # Default/document (original bytes, streamed as-is; no photo constraints)
+    return "document", name, content, m or "application/octet-stream"
+
+SEND_METHOD = {"photo": "sendPhoto", "document": "sendDocument"}
+
+def _digest(content: bytes | BinaryIO) -> Optional[str]:
+    # streams can't be hashed without consuming them; only in-memory payloads are deduped
+    if isinstance(content, (bytes, bytearray)):
+        return hashlib.sha256(content, usedforsecurity=False).hexdigest()
+    return None
+
+def _remember(digest: Optional[str], msg: dict, mime: str):
+    # keep Telegram's file_id for this content so a re-send needs no upload
+    if not digest: return
+    if msg.get("photo"):
+        save_upload(digest, "photo", msg["photo"][-1]["file_id"], mime)
+    elif msg.get("document"):
+        save_upload(digest, "document", msg["document"]["file_id"], mime)
+
+def _upload(dest_chat_id: str, kind: str, name: str, content: bytes | BinaryIO, mime: str):
+    if kind == "photo":
+        try:
+            return tg_send("sendPhoto", chat_id=dest_chat_id, files={"photo": (name, content, mime)})
         except Exception as e:
-            # Fallback for dimension/processing issues
-            msg = str(e)
-            if any(x in msg for x in (
-                "PHOTO_INVALID_DIMENSIONS",
-                "IMAGE_PROCESS_FAILED",
-                "PHOTO_EXT_INVALID",
-            )):
-                pass  # fall through to document
-            else:
+            if not _is_photo_error(e):
                 raise
-
-    # Default/document fallback (original bytes; no photo constraints)
-    files = {"document": (name, content, m or "application/octet-stream")}
+    files = {"document": (name, content, mime)}
     return tg_send("sendDocument", chat_id=dest_chat_id, files=files)
 
+def send_prepared(dest_chat_id: str, kind: str, name: str, content: bytes | BinaryIO, mime: str):
+    digest = _digest(content)
+    hit = get_upload(digest) if digest else None
+    if hit:
+        ref_kind, file_id = hit
+        try:
+            return tg_send(SEND_METHOD[ref_kind], chat_id=dest_chat_id, **{ref_kind: file_id})
+        except Exception as e:
+            if not _is_file_id_error(e):
+                raise
+            # stale file_id; upload again
+    j = _upload(dest_chat_id, kind, name, content, mime)
+    _remember(digest, j["result"], mime)
+    return j
+
+def send_album(dest_chat_id: str, group: list[tuple]) -> list[Optional[Exception]]:
+    """
+    Send up to ALBUM_MAX prepared photos in one sendMediaGroup call.
+    A single item goes through send_prepared (albums need 2+ items).
+    Photos Telegram already has are referenced by file_id instead of re-uploaded.
+    Returns one entry per item: None if it was posted, else the error that stopped it.
+    """
+    if len(group) == 1:
+        send_prepared(dest_chat_id, *group[0])
+        return [None]
+    media, files, digests = [], {}, []
+    for i, (kind, name, content, mime) in enumerate(group):
+        digest = _digest(content)
+        hit = get_upload(digest) if digest else None
+        if hit and hit[0] == kind:
+            media.append({"type": kind, "media": hit[1]})
+            digests.append(None)
+        else:
+            media.append({"type": kind, "media": f"attach://file{i}"})
+            files[f"file{i}"] = (name, content, mime)
+            digests.append(digest)
+    try:
+        j = tg_send("sendMediaGroup", chat_id=dest_chat_id, media=json_dumps(media), files=files)
+    except Exception as e:
+        if not (_is_photo_error(e) or (len(files) < len(group) and _is_file_id_error(e))):
+            raise
+        # one bad photo (or stale file_id) fails the whole album; resend one by one
+        errors = []
+        for item in group:
+            try:
+                send_prepared(dest_chat_id, *item)
+                errors.append(None)
+            except Exception as ex:
+                errors.append(ex)
+        return errors
+    for digest, msg, (_, _, _, mime) in zip(digests, j["result"], group):
+        _remember(digest, msg, mime)
+    return [None] * len(group)
+
 # --- Picker flow ---
 def create_picker_session(access_token:str)->dict:
-    r = requests.post(f"{PHOTOS_PICKER_BASE}/sessions",
-                      headers={"Authorization": f"Bearer {access_token}"},
-                      json={}, timeout=30)
+    r = SESSION.post(f"{PHOTOS_PICKER_BASE}/sessions",
+                     headers={"Authorization": f"Bearer {access_token}"},
+                     json={}, timeout=30)
     r.raise_for_status()
     return r.json()  # {id, pickerUri, pollingConfig?}
 
-def session_ready(access_token:str, sid:str)->dict:
-    r = requests.get(f"{PHOTOS_PICKER_BASE}/sessions/{sid}",
-                     headers={"Authorization": f"Bearer {access_token}"},
-                     timeout=30)
+def session_ready(access_token:str, sid:str, etag:str|None=None)->tuple[Optional[dict],Optional[str],Optional[str]]:
+    """Returns (session, etag, retry_after); session is None on 304 (unchanged since etag)."""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    r = SESSION.get(f"{PHOTOS_PICKER_BASE}/sessions/{sid}", headers=headers, timeout=30)
+    retry_after = r.headers.get("Retry-After")
+    if r.status_code == 304:
+        return None, etag, retry_after
     r.raise_for_status()
-    return r.json()
+    return r.json(), r.headers.get("ETag"), retry_after
+
+def poll_delay(base: float, attempt: int, retry_after: str | None = None) -> float:
+    """Jittered exponential backoff from base up to POLL_MAX; a numeric Retry-After wins, clamped to that range."""
+    if retry_after:
+        try:
+            return max(base, min(POLL_MAX, float(retry_after)))
+        except ValueError:
+            pass
+    # cap the exponent: attempt grows without bound and 2**big overflows float
+    return min(POLL_MAX, base * 2 ** min(attempt, 16)) * random.uniform(0.8, 1.2)
 
 def iter_picked(access_token:str, sid:str):
     params = {"sessionId": sid, "pageSize": 100}
+    attempt = 0
     while True:
-        r = requests.get(f"{PHOTOS_PICKER_BASE}/mediaItems",
-                         headers={"Authorization": f"Bearer {access_token}"},
-                         params=params, timeout=60)
+        r = SESSION.get(f"{PHOTOS_PICKER_BASE}/mediaItems",
+                        headers={"Authorization": f"Bearer {access_token}"},
+                        params=params, timeout=60)
         if r.status_code == 412 or r.status_code == 400:
-            time.sleep(3); continue
+            time.sleep(poll_delay(3.0, attempt, r.headers.get("Retry-After")))
+            attempt += 1
+            continue
+        attempt = 0
         r.raise_for_status()
         data = r.json()
         for it in data.get("mediaItems", []):
@@ -295,19 +629,74 @@ def iter_picked(access_token:str, sid:str):
         if not nxt: break
         params["pageToken"] = nxt
 
-def download_item(access_token:str, item:dict)->tuple[bytes,str,str]:
+def download_item(access_token:str, item:dict)->tuple[bytes | BinaryIO,str,str,int]:
+    """Returns (content, name, mime, size); bodies over PHOTO_MAX are spooled to disk, not memory."""
     mf = item.get("mediaFile", {}) or {}
     base_url = mf.get("baseUrl") or item.get("baseUrl")
     mime = mf.get("mimeType") or item.get("mimeType") or ""
     name = item.get("filename") or mf.get("filename") or f"{item.get('id','file')}"
     if not base_url: raise RuntimeError("No baseUrl")
     url = base_url + ("=dv" if mime.startswith("video/") else "=d")
-    r = requests.get(url, headers={"Authorization": f"Bearer {access_token}"}, timeout=300)
+    r = SESSION.get(url, headers={"Authorization": f"Bearer {access_token}"}, stream=True, timeout=300)
     r.raise_for_status()
-    return r.content, name, mime
+    size = int(r.headers.get("Content-Length", 0))
+    if size > FILE_MAX:
+        r.close()  # headers are enough to refuse; don't pull the body
+        raise RuntimeError("File exceeds 2GB")
+    r.raw.decode_content = True
+    with r:
+        content, size = _spool(r.raw)
+    return content, name, mime, size
+
+_STOP = object()
+
+def transfer(jobs, upload, workers: int = UPLOAD_WORKERS, depth: int = 2):
+    """
+    Overlap the download and upload legs of a picker job.
+    A feeder thread pulls from `jobs` (a lazy iterable that does the downloading)
+    into a bounded queue; `workers` threads call upload(job) on what it produced.
+    Yields (job, result, error) as uploads finish: upload(job)'s return value, or the error it raised.
+    If `jobs` itself raises, that error is re-raised once in-flight uploads are done.
+    """
+    pending = queue.Queue(maxsize=depth)
+    results = queue.Queue()
+    failed = []
+
+    def feed():
+        try:
+            for job in jobs:
+                pending.put(job)
+        except Exception as ex:
+            failed.append(ex)
+        finally:
+            for _ in range(workers):
+                pending.put(_STOP)
+
+    def drain():
+        while (job := pending.get()) is not _STOP:
+            try:
+                results.put((job, upload(job), None))
+            except Exception as ex:
+                results.put((job, None, ex))
+        results.put(_STOP)
+
+    with ThreadPoolExecutor(max_workers=workers + 1) as ex:
+        ex.submit(feed)
+        for _ in range(workers):
+            ex.submit(drain)
+        finished = 0
+        while finished < workers:
+            res = results.get()
+            if res is _STOP:
+                finished += 1
+            else:
+                yield res
+    if failed:
+        raise failed[0]
 
-# --- FastAPI for OAuth callback ---
+# --- FastAPI for OAuth callback + Telegram webhook ---
 app = FastAPI()
+tg_app: Optional[Application] = None  # set in serve()
 
 @app.get(REDIRECT_PATH)
 def oauth_cb(request: Request):
@@ -319,11 +708,7 @@ def oauth_cb(request: Request):
     tg_id = int(state.split(":")[0])   # simple state "TGID:nonce"
     token = exchange_code(code)
 
-    # (Optional) fetch email
-    userinfo = requests.get("https://openidconnect.googleapis.com/v1/userinfo",
-                            headers={"Authorization": f"Bearer {token['access_token']}"},
-                            timeout=20)
-    email = userinfo.json().get("email") if userinfo.ok else None
+    email = id_token_email(token)
 
     save_tokens(tg_id, token, email)
     # notify user in DM
@@ -331,8 +716,12 @@ def oauth_cb(request: Request):
             text="✅ Google connected (Picker). Use /picker to select photos.")
     return {"ok": True}
 
-def run_api():
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+@app.post(TG_WEBHOOK_PATH)
+async def tg_webhook(request: Request):
+    if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), TG_WEBHOOK_SECRET):
+        return Response(status_code=403)
+    await tg_app.update_queue.put(Update.de_json(await request.json(), tg_app.bot))
+    return Response()
 
 # --- Telegram bot handlers ---
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -362,7 +751,7 @@ async def connect_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def setchannel_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     code = str(int(time.time()))[-6:]  # simple code
-    put_link_code(code, update.effective_user.id)
+    await asyncio.to_thread(put_link_code, code, update.effective_user.id)
     await update.message.reply_text(
         "Linking channel:\n"
         "• Easiest: forward any message from your channel to me, or\n"
@@ -375,7 +764,7 @@ async def on_forward(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not msg or not msg.forward_from_chat: return
     ch: Chat = msg.forward_from_chat
     if ch.type != Chat.CHANNEL: return
-    save_channel(update.effective_user.id, str(ch.id), ch.title or "")
+    await asyncio.to_thread(save_channel, update.effective_user.id, str(ch.id), ch.title or "")
     await msg.reply_text(f"✅ Linked channel: {ch.title or ch.id}")
 
 async def on_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -385,14 +774,14 @@ async def on_channel_post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     parts = post.text.strip().split()
     if len(parts) == 2 and parts[0].lower() == "/link":
         code = parts[1]
-        tg_id = pop_link_code(code)
+        tg_id = await asyncio.to_thread(pop_link_code, code)
         if tg_id:
-            save_channel(tg_id, str(post.chat.id), post.chat.title or "")
+            await asyncio.to_thread(save_channel, tg_id, str(post.chat.id), post.chat.title or "")
             try:
-                tg_send("sendMessage", chat_id=tg_id,
-                        text=f"✅ Linked channel: {post.chat.title or post.chat.id}")
+                await ctx.bot.send_message(tg_id, f"✅ Linked channel: {post.chat.title or post.chat.id}")
             except Exception:
                 pass
+
 def _parse_poll_seconds(session_status: dict, default: float = 3.0) -> float:
     """Parse pollingConfig.pollInterval which can be '5s', '500ms', '1m', number, etc."""
     raw = (session_status.get("pollingConfig", {}) or {}).get("pollInterval", default)
@@ -412,19 +801,20 @@ def _parse_poll_seconds(session_status: dict, default: float = 3.0) -> float:
         return max(2.0, default)
 
 async def picker_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    # DB + Google calls are blocking; keep them off the bot's event loop
+    u = await asyncio.to_thread(get_user, update.effective_user.id)
     if not u:
         await update.message.reply_text("Please /connect Google first.")
         return
-    ch = get_channel(update.effective_user.id)
+    ch = await asyncio.to_thread(get_channel, update.effective_user.id)
     if not ch:
         await update.message.reply_text("Please /setchannel first.")
         return
 
     await update.message.reply_text("Creating a Picker session...")
     try:
-        access = get_access_token(u)
-        sess = create_picker_session(access)
+        access = await asyncio.to_thread(get_access_token, u["tg_id"])
+        sess = await asyncio.to_thread(create_picker_session, access)
     except Exception as e:
         await update.message.reply_text(f"Failed to create session: {e}")
         return
@@ -439,42 +829,83 @@ async def picker_cmd(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     def worker(tg_id:int, chat_id:str, session_id:str):
         try:
             # wait until user finished picking
+            attempt, st, etag = 0, {}, None
             while True:
-                st = session_ready(get_access_token(get_user(tg_id)), session_id)
+                fresh, etag, retry_after = session_ready(get_access_token(tg_id), session_id, etag)
+                st = fresh or st  # 304: nothing changed
                 if st.get("mediaItemsSet"): break
-                time.sleep(_parse_poll_seconds(st))
+                time.sleep(poll_delay(_parse_poll_seconds(st), attempt, retry_after))
+                attempt += 1
+
+            def albums():
+                # photos are batched into albums; anything else flushes the batch and goes alone
+                batch = []
+                for it in iter_picked(get_access_token(tg_id), session_id):
+                    try:
+                        content, name, mime, size = download_item(get_access_token(tg_id), it)
+                        media = prepare_media(name, content, mime, size)
+                    except Exception as ex:
+                        tg_send("sendMessage", chat_id=tg_id, text=f"Skipped one: {ex}")
+                        continue
+                    if media[0] != "photo":
+                        if batch: yield batch
+                        batch = []
+                        yield [media]
+                        continue
+                    batch.append(media)
+                    if len(batch) == ALBUM_MAX:
+                        yield batch
+                        batch = []
+                if batch: yield batch
+
             sent = 0
-            for it in iter_picked(get_access_token(get_user(tg_id)), session_id):
-                try:
-                    content, name, mime = download_item(get_access_token(get_user(tg_id)), it)
-                    send_media_auto(chat_id, name, content, mime)
-                    sent += 1
-                    if sent % 10 == 0:
-                        tg_send("sendMessage", chat_id=tg_id, text=f"Progress: {sent} sent…")
-                    time.sleep(0.5)
-                except Exception as ex:
-                    tg_send("sendMessage", chat_id=tg_id, text=f"Skipped one: {ex}")
+            for group, errors, err in transfer(albums(), lambda group: send_album(chat_id, group)):
+                failed = [err] * len(group) if err else [ex for ex in errors if ex]
+                if failed:
+                    tg_send("sendMessage", chat_id=tg_id, text=f"Skipped {len(failed)} item(s): {failed[0]}")
+                before, sent = sent, sent + len(group) - len(failed)
+                if sent // 10 > before // 10:
+                    tg_send("sendMessage", chat_id=tg_id, text=f"Progress: {sent} sent…")
             tg_send("sendMessage", chat_id=tg_id, text=f"✅ Done. Sent {sent} item(s).")
         except Exception as ex:
             tg_send("sendMessage", chat_id=tg_id, text=f"❌ Picker job failed: {ex}")
 
+    # long-running job: own thread, so it never ties up the to_thread executor
     threading.Thread(target=worker, args=(update.effective_user.id, ch["chat_id"], sess["id"]), daemon=True).start()
 
+def build_bot() -> Application:
+    # no Updater: updates arrive through tg_webhook on the FastAPI app
+    bot = Application.builder().token(BOT_TOKEN).updater(None).build()
+    bot.add_handler(CommandHandler("start", start))
+    bot.add_handler(CommandHandler("help", help_cmd))
+    bot.add_handler(CommandHandler("connect", connect_cmd))
+    bot.add_handler(CommandHandler("setchannel", setchannel_cmd))
+    bot.add_handler(CommandHandler("picker", picker_cmd))
+    bot.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, on_forward))
+    # NOTE: This filter works in practice for channel posts on PTB v20.
+    bot.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, on_channel_post))
+    return bot
+
+async def serve():
+    """OAuth callback, Telegram webhook and PTB handlers all on one event loop."""
+    global tg_app
+    tg_app = build_bot()
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=8000, log_level="info"))
+    async with tg_app:
+        await tg_app.bot.set_webhook(f"{PUBLIC_BASE}{TG_WEBHOOK_PATH}", secret_token=TG_WEBHOOK_SECRET,
+                                     allowed_updates=Update.ALL_TYPES)
+        await tg_app.start()
+        try:
+            await server.serve()
+        finally:
+            await tg_app.stop()
+
 def main():
     init_db()
-    # Start API (OAuth callback) in a thread
-    threading.Thread(target=run_api, daemon=True).start()
-
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("connect", connect_cmd))
-    app.add_handler(CommandHandler("setchannel", setchannel_cmd))
-    app.add_handler(CommandHandler("picker", picker_cmd))
-    app.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, on_forward))
-    # NOTE: This filter works in practice for channel posts on PTB v20.
-    app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, on_channel_post))
-    app.run_polling()
+    try:
+        asyncio.run(serve())
+    finally:
+        pool.close()
 
 if __name__ == "__main__":
     if not (BOT_TOKEN and CLIENT_ID and CLIENT_SECRET and PUBLIC_BASE):
@@ -1,6 +1,13 @@
-import os, json, time, mimetypes
+import os, json, time, mimetypes, threading, sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 
 from google.oauth2.credentials import Credentials
@@ -11,7 +18,9 @@ from google.auth.transport.requests import AuthorizedSession, Request
 BOT_TOKEN   = os.getenv("TG_BOT_TOKEN",   "YOUR_TELEGRAM_BOT_TOKEN")
 CHANNEL_ID  = os.getenv("TG_CHANNEL_ID",  "@yourchannelusername")  # or -1001234567890
 PAGE_SIZE   = 100   # Photos API max page size
-BATCH_SLEEP = 0.5   # seconds between Telegram uploads
+BATCH_SLEEP = 0.5   # min seconds between Telegram uploads
+WORKERS     = 4     # downloads running ahead of the (in-order) uploads
+TG_RETRIES  = 5     # attempts per upload when Telegram answers 429
 # ─────────────────────────────────────────────────────────────────────────────
 
 # IMPORTANT: These legacy scopes are no longer available for most new apps (Mar 31, 2025).
@@ -19,10 +28,20 @@ BATCH_SLEEP = 0.5   # seconds between Telegram uploads
 SCOPES = ["https://www.googleapis.com/auth/photoslibrary.readonly"]
 
 TOKEN_FILE = "token.json"
-PROGRESS_FILE = "processed_ids.jsonl"
+PROGRESS_DB = "processed.db"
+PROGRESS_FILE = "processed_ids.jsonl"   # legacy log; imported into PROGRESS_DB once
+COMMIT_EVERY = 50                       # processed ids per progress commit
+SPOOL_MAX = 10 * 1024 * 1024            # downloads bigger than this are spooled to disk
 
 PHOTOS_BASE = "https://photoslibrary.googleapis.com/v1/mediaItems"
 
+# Keep-alive session for Telegram uploads (Google calls go through AuthorizedSession)
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 def get_creds():
     creds = None
     if os.path.exists(TOKEN_FILE):
@@ -38,23 +57,37 @@ def get_creds():
             f.write(creds.to_json())
     return creds
 
-def load_done_ids():
-    done = set()
+def open_progress() -> sqlite3.Connection:
+    conn = sqlite3.connect(PROGRESS_DB)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS processed(id TEXT PRIMARY KEY);
+    """)
     if os.path.exists(PROGRESS_FILE):
+        ids = []
         with open(PROGRESS_FILE) as f:
             for line in f:
                 try:
-                    done.add(json.loads(line)["id"])
+                    ids.append((json.loads(line)["id"],))
                 except Exception:
                     pass
-    return done
-
-def mark_done(item_id):
-    with open(PROGRESS_FILE, "a") as f:
-        f.write(json.dumps({"id": item_id}) + "\n")
-
-def download_bytes(session: AuthorizedSession, item: dict) -> tuple[bytes,str,str]:
-    """Returns (content_bytes, filename, mime_type). Uses =d for photos, =dv for videos."""
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO processed(id) VALUES(?)", ids)
+        os.replace(PROGRESS_FILE, PROGRESS_FILE + ".imported")
+    return conn
+
+def load_done_ids(conn: sqlite3.Connection, ids: list[str]) -> set[str]:
+    """Which of this page's ids were already sent (one indexed lookup per page, no full load)."""
+    marks = ",".join("?" * len(ids))
+    return {r[0] for r in conn.execute(f"SELECT id FROM processed WHERE id IN ({marks})", ids)}
+
+def mark_done(conn: sqlite3.Connection, item_id):
+    # committed in batches by the caller
+    conn.execute("INSERT OR IGNORE INTO processed(id) VALUES(?)", (item_id,))
+
+def download_bytes(session: AuthorizedSession, item: dict) -> tuple[bytes | BinaryIO,str,str]:
+    """Returns (content, filename, mime_type). Uses =d for photos, =dv for videos."""
     base_url = item.get("baseUrl")
     mime_type = item.get("mimeType", "")
     filename  = item.get("filename") or f'{item["id"]}'
@@ -69,10 +102,18 @@ def download_bytes(session: AuthorizedSession, item: dict) -> tuple[bytes,str,st
     # Auth header required; baseUrl is NOT public
     r = session.get(url, stream=True)
     r.raise_for_status()
-    content = r.content
-    return content, filename, mime_type
-
-def send_to_telegram(content: bytes, filename: str, mime_type: str):
+    # spool the body: up to SPOOL_MAX comes back as bytes, anything bigger as a temp file
+    buf = SpooledTemporaryFile(max_size=SPOOL_MAX)
+    for chunk in r.iter_content(chunk_size=1 << 20):
+        buf.write(chunk)
+    size = buf.tell()
+    buf.seek(0)
+    if size <= SPOOL_MAX:
+        with buf:
+            return buf.read(), filename, mime_type
+    return buf, filename, mime_type
+
+def send_to_telegram(content: bytes | BinaryIO, filename: str, mime_type: str):
     api = f"https://api.telegram.org/bot{BOT_TOKEN}"
     files = None
     data = {"chat_id": CHANNEL_ID, "caption": filename}
@@ -90,13 +131,57 @@ def send_to_telegram(content: bytes, filename: str, mime_type: str):
             files = {"document": (filename, content, mime_type or "application/octet-stream")}
             url = f"{api}/sendDocument"
 
-        resp = requests.post(url, data=data, files=files, timeout=300)
-        j = resp.json() if resp.headers.get("content-type","").startswith("application/json") else {}
+        for attempt in range(TG_RETRIES):
+            if hasattr(content, "seek"):
+                content.seek(0)  # a retry re-sends the spooled body from the start
+            # streamed multipart body; requests' files= would read the whole file into memory
+            body = MultipartEncoder({**data, **files})
+            resp = SESSION.post(url, data=body, headers={"Content-Type": body.content_type}, timeout=300)
+            j = resp.json() if resp.headers.get("content-type","").startswith("application/json") else {}
+            if resp.status_code != 429 or attempt == TG_RETRIES - 1:
+                break
+            # flood control: Telegram says how long to back off
+            time.sleep((j.get("parameters") or {}).get("retry_after", 1))
         if resp.status_code != 200 or not j.get("ok", False):
             raise RuntimeError(f"Telegram error: {resp.status_code} {j}")
     finally:
         files = None
 
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across all threads."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+tg_rate = RateLimiter(1 / BATCH_SLEEP)
+
+def fetch_one(session: AuthorizedSession, item: dict):
+    content, filename, mime_type = download_bytes(session, item)
+    # If filename has no extension, guess one
+    if "." not in filename:
+        ext = mimetypes.guess_extension(mime_type or "") or ""
+        filename = filename + ext
+    return content, filename, mime_type
+
+def prefetch(pool: ThreadPoolExecutor, fn, items, depth: int):
+    """Yield (item, future of fn(item)) in input order, with up to `depth` calls running ahead."""
+    window = deque()
+    for it in items:
+        window.append((it, pool.submit(fn, it)))
+        if len(window) > depth:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
 def main():
     # Basic checks
     if "YOUR_TELEGRAM_BOT_TOKEN" in BOT_TOKEN:
@@ -105,51 +190,55 @@ def main():
     creds = get_creds()
     session = AuthorizedSession(creds)
 
-    done_ids = load_done_ids()
+    progress = open_progress()
     page_token = None
     total_sent = 0
 
-    with tqdm(desc="Exporting", unit="item") as bar:
-        while True:
-            params = {"pageSize": PAGE_SIZE}
-            if page_token:
-                params["pageToken"] = page_token
-
-            # List media items (requires legacy read scope)
-            r = session.get(PHOTOS_BASE, params=params)
-            if r.status_code == 403:
-                raise SystemExit(
-                    "403 Insufficient scopes from Google Photos API.\n"
-                    "Google removed general library read scopes in 2025. "
-                    "Unless your project is approved/allowlisted, you can't enumerate the full library."
-                )
-            r.raise_for_status()
-            data = r.json()
-            items = data.get("mediaItems", []) or []
-
-            if not items:
-                break
-
-            for it in items:
-                if it["id"] in done_ids:
-                    continue
-                try:
-                    content, filename, mime_type = download_bytes(session, it)
-                    # If filename has no extension, guess one
-                    if "." not in filename:
-                        ext = mimetypes.guess_extension(mime_type or "") or ""
-                        filename = filename + ext
-                    send_to_telegram(content, filename, mime_type)
-                    mark_done(it["id"])
-                    total_sent += 1
-                    bar.update(1)
-                    time.sleep(BATCH_SLEEP)
-                except Exception as e:
-                    print(f"⚠️  Skipped {it.get('id')} ({it.get('filename')}): {e}")
-
-            page_token = data.get("nextPageToken")
-            if not page_token:
-                break
+    try:
+        # Workers download ahead; uploads and bookkeeping stay on this thread, in listing order
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool, tqdm(desc="Exporting", unit="item") as bar:
+            while True:
+                params = {"pageSize": PAGE_SIZE}
+                if page_token:
+                    params["pageToken"] = page_token
+
+                # List media items (requires legacy read scope)
+                r = session.get(PHOTOS_BASE, params=params)
+                if r.status_code == 403:
+                    raise SystemExit(
+                        "403 Insufficient scopes from Google Photos API.\n"
+                        "Google removed general library read scopes in 2025. "
+                        "Unless your project is approved/allowlisted, you can't enumerate the full library."
+                    )
+                r.raise_for_status()
+                data = r.json()
+                items = data.get("mediaItems", []) or []
+
+                if not items:
+                    break
+
+                done_ids = load_done_ids(progress, [it["id"] for it in items])
+                todo = [it for it in items if it["id"] not in done_ids]
+                for it, fut in prefetch(pool, lambda it: fetch_one(session, it), todo, WORKERS):
+                    try:
+                        content, filename, mime_type = fut.result()
+                        tg_rate.wait()
+                        send_to_telegram(content, filename, mime_type)
+                        mark_done(progress, it["id"])
+                        total_sent += 1
+                        bar.update(1)
+                        if total_sent % COMMIT_EVERY == 0:
+                            progress.commit()
+                    except Exception as e:
+                        print(f"⚠️  Skipped {it.get('id')} ({it.get('filename')}): {e}")
+
+                page_token = data.get("nextPageToken")
+                if not page_token:
+                    break
+    finally:
+        # keep whatever was sent, even on Ctrl-C / errors
+        progress.commit()
+        progress.close()
 
     print(f"✅ Done. Posted {total_sent} items to {CHANNEL_ID}.")
 
@@ -1,6 +1,13 @@
-import os, time, json, mimetypes
+import os, time, json, mimetypes, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from tqdm import tqdm
 
@@ -15,6 +22,17 @@ CHANNEL_ID = os.getenv("TG_CHANNEL_ID")
 
 SCOPE  = ["https://www.googleapis.com/auth/photospicker.mediaitems.readonly"]
 BASE   = "https://photospicker.googleapis.com/v1"
+WORKERS       = 4         # downloads running ahead of the (in-order) uploads
+SEND_INTERVAL = 3.0       # min seconds between uploads: Telegram allows ~20 msg/min per channel
+TG_RETRIES    = 5         # attempts per upload when Telegram answers 429
+SPOOL_MAX     = 10 * 1024 * 1024  # downloads bigger than this are spooled to disk
+
+# Keep-alive session for Telegram uploads (Google calls go through AuthorizedSession)
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 def get_creds():
     creds = None
@@ -62,11 +80,20 @@ def dl_bytes(sess: AuthorizedSession, item: dict):
     fn       = item.get("filename") or mf.get("filename") or f"{item.get('id','file')}"
     if not base_url: raise RuntimeError("No baseUrl in picked item")
     url = base_url + ("=dv" if mime.startswith("video/") else "=d")
-    r = sess.get(url)
+    r = sess.get(url, stream=True)
     r.raise_for_status()
-    return r.content, fn, mime
-
-def tg_send(content: bytes, filename: str, mime: str):
+    # spool the body: up to SPOOL_MAX comes back as bytes, anything bigger as a temp file
+    buf = SpooledTemporaryFile(max_size=SPOOL_MAX)
+    for chunk in r.iter_content(chunk_size=1 << 20):
+        buf.write(chunk)
+    size = buf.tell()
+    buf.seek(0)
+    if size <= SPOOL_MAX:
+        with buf:
+            return buf.read(), fn, mime
+    return buf, fn, mime
+
+def tg_send(content: bytes | BinaryIO, filename: str, mime: str):
     api = f"https://api.telegram.org/bot{BOT_TOKEN}"
     data = {"chat_id": CHANNEL_ID}
     if mime.startswith("image/"):
@@ -78,11 +105,47 @@ def tg_send(content: bytes, filename: str, mime: str):
     else:
         files = {"document": (filename, content, mime or "application/octet-stream")}
         url = f"{api}/sendDocument"
-    resp = requests.post(url, data=data, files=files, timeout=300)
-    j = resp.json()
+    for attempt in range(TG_RETRIES):
+        if hasattr(content, "seek"):
+            content.seek(0)  # a retry re-sends the spooled body from the start
+        # streamed multipart body; requests' files= would read the whole file into memory
+        body = MultipartEncoder({**data, **files})
+        resp = SESSION.post(url, data=body, headers={"Content-Type": body.content_type}, timeout=300)
+        j = resp.json()
+        if resp.status_code != 429 or attempt == TG_RETRIES - 1:
+            break
+        # flood control: Telegram says how long to back off
+        time.sleep((j.get("parameters") or {}).get("retry_after", 1))
     if resp.status_code != 200 or not j.get("ok", False):
         raise RuntimeError(f"Telegram error {resp.status_code}: {j}")
 
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across all threads."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+tg_rate = RateLimiter(1 / SEND_INTERVAL)
+
+def prefetch(pool: ThreadPoolExecutor, fn, items, depth: int):
+    """Yield (item, future of fn(item)) in input order, with up to `depth` calls running ahead."""
+    window = deque()
+    for it in items:
+        window.append((it, pool.submit(fn, it)))
+        if len(window) > depth:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
 def main():
     if not BOT_TOKEN or not CHANNEL_ID:
         raise SystemExit("Set TG_BOT_TOKEN and TG_CHANNEL_ID in .env")
@@ -107,15 +170,18 @@ def main():
         time.sleep(max(2, poll))
 
     # 3) list picked items and forward to Telegram
+    # (workers download ahead; uploads go out from this thread in pick order)
     count = 0
-    for it in tqdm(list_picked(sess, sid), desc="Uploading to Telegram", unit="item"):
-        try:
-            content, fn, mime = dl_bytes(sess, it)
-            tg_send(content, fn, mime)
-            count += 1
-            time.sleep(0.5)  # be gentle with rate limits
-        except Exception as e:
-            print("⚠️ Skipped:", e)
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool, tqdm(desc="Uploading to Telegram", unit="item") as bar:
+        for it, fut in prefetch(pool, lambda it: dl_bytes(sess, it), list_picked(sess, sid), WORKERS):
+            try:
+                content, fn, mime = fut.result()
+                tg_rate.wait()
+                tg_send(content, fn, mime)
+                count += 1
+                bar.update(1)
+            except Exception as e:
+                print("⚠️ Skipped:", e)
 
     # 4) optional cleanup
     try: